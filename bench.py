@@ -0,0 +1,86 @@
+"""HTTP/1.1 与 HTTP/2 并发小请求基准测试
+
+模拟浏览器同时请求大量小资源（文件列表、脚本、样式等）：
+- HTTP/1.1：每个源最多6个连接（与浏览器限制一致）
+- HTTP/2：所有请求在一个连接上多路复用（需要前置HTTP/2反向代理）
+
+依赖：pip install "httpx[http2]"
+
+示例：
+    python bench.py http://127.0.0.1:8888
+    python bench.py https://127.0.0.1:8888 --insecure
+    python bench.py https://127.0.0.1:8443 --insecure --http2
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+
+
+async def run_bench(base_url, paths, total, concurrency, connections, http2, verify):
+    """并发发出total个请求，返回(总耗时, 各请求耗时列表, 实际协议)"""
+    import httpx
+
+    limits = httpx.Limits(max_connections=1 if http2 else connections)
+    latencies = []
+    versions = set()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, http2=http2, verify=verify, limits=limits) as client:
+        # 预热：建立连接、完成TLS握手
+        await client.get(paths[0])
+
+        async def one(i):
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.get(paths[i % len(paths)])
+                await response.aread()
+                latencies.append(time.perf_counter() - start)
+                versions.add(response.http_version)
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+
+    return elapsed, latencies, ', '.join(sorted(versions))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP/1.1 与 HTTP/2 并发小请求基准测试')
+    parser.add_argument('url', help='服务器地址，如 http://127.0.0.1:8888')
+    parser.add_argument('--requests', type=int, default=2000, help='请求总数（默认2000）')
+    parser.add_argument('--concurrency', type=int, default=64, help='同时发出的请求数（默认64）')
+    parser.add_argument('--connections', type=int, default=6, help='HTTP/1.1连接数上限（默认6，与浏览器一致）')
+    parser.add_argument('--paths', default='/api/files,/app.js,/style.css', help='轮流请求的路径，逗号分隔')
+    parser.add_argument('--http2', action='store_true', help='使用HTTP/2（单连接多路复用）')
+    parser.add_argument('--insecure', action='store_true', help='不校验证书（自签名证书）')
+    args = parser.parse_args()
+
+    try:
+        import httpx  # noqa: F401
+        if args.http2:
+            import h2  # noqa: F401
+    except ImportError:
+        print('需要安装: pip install "httpx[http2]"')
+        sys.exit(1)
+
+    paths = [p.strip() for p in args.paths.split(',') if p.strip()]
+    elapsed, latencies, versions = asyncio.run(run_bench(
+        args.url, paths, args.requests, args.concurrency, args.connections,
+        args.http2, not args.insecure
+    ))
+
+    latencies.sort()
+    print(f"地址:     {args.url}")
+    print(f"协议:     {versions}")
+    print(f"请求数:   {args.requests}（并发 {args.concurrency}）")
+    print(f"总耗时:   {elapsed:.2f} s")
+    print(f"吞吐:     {args.requests / elapsed:.0f} req/s")
+    print(f"延迟p50:  {statistics.median(latencies) * 1000:.1f} ms")
+    print(f"延迟p95:  {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -7,11 +7,22 @@ class FileTransferApp {
         this.clientName = '等待分配...';
         this.messages = [];
         this.isHistoryVisible = false;
+        this.wsEpoch = null;  // 服务器启动标识，变化时需重新拉取全部历史
+        this.lastSeq = 0;     // 已收到的最后一条消息序号
+        
+        // 上传设置：小文件打包成tar批量上传，多个请求并行
+        this.uploadConcurrency = 4;
+        this.smallFileSize = 4 * 1024 * 1024;
+        this.batchMaxFiles = 1000;
+        this.batchMaxBytes = 64 * 1024 * 1024;
         
         this.init();
     }
     
     async init() {
+        // 恢复上次的聊天同步状态，刷新页面后只需增量获取历史
+        this.restoreChatState();
+        
         // 加载房间信息
         await this.loadRoomInfo();
         
@@ -48,9 +59,16 @@ class FileTransferApp {
     
     initWebSocket() {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${window.location.host}/ws`;
+        const params = new URLSearchParams({ since: this.lastSeq });
+        if (this.wsEpoch) params.set('epoch', this.wsEpoch);
+        const wsUrl = `${protocol}//${window.location.host}/ws?${params}`;
+        
+        // 协商子协议：优先MessagePack二进制，其次精简JSON
+        const subprotocols = ['fileshare.v2.json'];
+        if (window.MessagePack) subprotocols.unshift('fileshare.v2.msgpack');
         
-        this.ws = new WebSocket(wsUrl);
+        this.ws = new WebSocket(wsUrl, subprotocols);
+        this.ws.binaryType = 'arraybuffer';
         
         this.ws.onopen = () => {
             console.log('WebSocket连接已建立');
@@ -61,7 +79,9 @@ class FileTransferApp {
         
         this.ws.onmessage = (event) => {
             try {
-                const data = JSON.parse(event.data);
+                const data = event.data instanceof ArrayBuffer
+                    ? MessagePack.decode(new Uint8Array(event.data))
+                    : JSON.parse(event.data);
                 this.handleWebSocketMessage(data);
             } catch (error) {
                 console.error('解析WebSocket消息失败:', error);
@@ -87,6 +107,14 @@ class FileTransferApp {
         };
     }
     
+    sendWebSocketMessage(data) {
+        if (this.ws.protocol === 'fileshare.v2.msgpack') {
+            this.ws.send(MessagePack.encode(data));
+        } else {
+            this.ws.send(JSON.stringify(data));
+        }
+    }
+    
     handleWebSocketMessage(data) {
         try {
             switch (data.type) {
@@ -94,13 +122,35 @@ class FileTransferApp {
                     this.clientName = data.client_name || '未知用户';
                     // 收到欢迎消息，显示聊天历史
                     if (data.chat_history) {
-                        this.addChatHistory(data.chat_history);
+                        if (data.epoch && data.epoch === this.wsEpoch) {
+                            // 重连：只补充断线期间的新消息
+                            data.chat_history.forEach(message => {
+                                if (message.seq > this.lastSeq) this.addMessage(message);
+                            });
+                        } else {
+                            this.addChatHistory(data.chat_history);
+                        }
+                    }
+                    if (data.epoch) {
+                        this.wsEpoch = data.epoch;
+                        this.lastSeq = data.last_seq || 0;
+                        this.saveChatState();
                     }
                     break;
                     
                 case 'chat_message':
-                    // 收到新聊天消息
+                    // 收到新聊天消息（欢迎消息中已包含的跳过）
+                    if (data.message.seq && data.message.seq <= this.lastSeq) break;
                     this.addMessage(data.message);
+                    if (data.message.seq) {
+                        this.lastSeq = data.message.seq;
+                        this.saveChatState();
+                    }
+                    break;
+                    
+                case 'batch':
+                    // 服务器合并发送的多条事件
+                    data.events.forEach(event => this.handleWebSocketMessage(event));
                     break;
             }
         } catch (error) {
@@ -108,6 +158,33 @@ class FileTransferApp {
         }
     }
     
+    restoreChatState() {
+        try {
+            const saved = JSON.parse(sessionStorage.getItem('fileshare.chat') || 'null');
+            if (!saved || !saved.epoch) return;
+            
+            this.wsEpoch = saved.epoch;
+            this.lastSeq = saved.lastSeq || 0;
+            if (saved.messages && saved.messages.length > 0) {
+                this.addChatHistory(saved.messages);
+            }
+        } catch (error) {
+            console.error('恢复聊天状态失败:', error);
+        }
+    }
+    
+    saveChatState() {
+        try {
+            sessionStorage.setItem('fileshare.chat', JSON.stringify({
+                epoch: this.wsEpoch,
+                lastSeq: this.lastSeq,
+                messages: this.messages
+            }));
+        } catch (error) {
+            console.error('保存聊天状态失败:', error);
+        }
+    }
+    
     addChatHistory(messages) {
         try {
             // 清空当前消息
@@ -274,7 +351,7 @@ class FileTransferApp {
             
             // 设置文件信息
             item.dataset.fileId = file.id;
-            item.querySelector('.file-name').textContent = file.name;
+            item.querySelector('.file-name').textContent = file.path || file.name;
             item.querySelector('.file-size').textContent = this.formatFileSize(file.size);
             item.querySelector('.file-date').textContent = this.formatDate(file.modified);
             
@@ -298,6 +375,8 @@ class FileTransferApp {
         try {
             const uploadZone = document.getElementById('uploadZone');
             const fileInput = document.getElementById('fileInput');
+            const folderInput = document.getElementById('folderInput');
+            const folderSelect = document.getElementById('folderSelect');
             const refreshBtn = document.getElementById('refreshBtn');
             const sharedTextInput = document.getElementById('sharedTextInput');
             const sharedTextSendBtn = document.getElementById('sharedTextSendBtn');
@@ -310,10 +389,25 @@ class FileTransferApp {
             
             // 选择文件
             fileInput.addEventListener('change', (e) => {
-                this.handleFileSelect(e.target.files);
+                this.handleFileSelect(Array.from(e.target.files, file => ({ file, path: file.name })));
                 fileInput.value = '';
             });
             
+            // 选择文件夹
+            folderSelect.addEventListener('click', (e) => {
+                e.preventDefault();
+                e.stopPropagation();
+                folderInput.click();
+            });
+            
+            folderInput.addEventListener('change', (e) => {
+                this.handleFileSelect(Array.from(e.target.files, file => ({
+                    file,
+                    path: file.webkitRelativePath || file.name
+                })));
+                folderInput.value = '';
+            });
+            
             // 拖放支持
             uploadZone.addEventListener('dragover', (e) => {
                 e.preventDefault();
@@ -329,7 +423,12 @@ class FileTransferApp {
                 uploadZone.classList.remove('dragover');
                 
                 if (e.dataTransfer.files.length > 0) {
-                    this.handleFileSelect(e.dataTransfer.files);
+                    this.collectDroppedFiles(e.dataTransfer)
+                        .then(entries => this.handleFileSelect(entries))
+                        .catch(error => {
+                            console.error('读取拖放文件失败:', error);
+                            this.showMessage('读取拖放文件失败', 'error');
+                        });
                 }
             });
             
@@ -402,10 +501,10 @@ class FileTransferApp {
             
             // 通过WebSocket发送消息
             if (this.ws && this.ws.readyState === WebSocket.OPEN) {
-                this.ws.send(JSON.stringify({
+                this.sendWebSocketMessage({
                     type: 'chat_message',
                     message: message
-                }));
+                });
                 
                 // 暂时显示发送中的消息
                 const tempMessage = {
@@ -445,29 +544,104 @@ class FileTransferApp {
         }
     }
     
-    async handleFileSelect(files) {
+    async collectDroppedFiles(dataTransfer) {
+        // 必须在drop事件中同步取得条目，之后DataTransfer会失效
+        const entries = Array.from(dataTransfer.items || [])
+            .filter(item => item.kind === 'file')
+            .map(item => item.webkitGetAsEntry ? item.webkitGetAsEntry() : null);
+        
+        if (entries.length === 0 || entries.some(entry => !entry)) {
+            return Array.from(dataTransfer.files, file => ({ file, path: file.name }));
+        }
+        
+        const result = [];
+        const walk = async (entry, prefix) => {
+            if (entry.isFile) {
+                const file = await new Promise((resolve, reject) => entry.file(resolve, reject));
+                result.push({ file, path: prefix + file.name });
+            } else if (entry.isDirectory) {
+                // readEntries每次只返回一部分，需要读到空为止
+                const reader = entry.createReader();
+                let children;
+                do {
+                    children = await new Promise((resolve, reject) => reader.readEntries(resolve, reject));
+                    for (const child of children) {
+                        await walk(child, `${prefix}${entry.name}/`);
+                    }
+                } while (children.length > 0);
+            }
+        };
+        
+        for (const entry of entries) {
+            await walk(entry, '');
+        }
+        return result;
+    }
+    
+    async handleFileSelect(entries) {
         try {
-            for (const file of files) {
-                await this.uploadFile(file);
+            const tasks = [];
+            let batch = [];
+            let batchBytes = 0;
+            
+            const flushBatch = () => {
+                const files = batch;
+                if (files.length === 1) {
+                    tasks.push(() => this.uploadFile(files[0].file, files[0].path));
+                } else if (files.length > 1) {
+                    tasks.push(() => this.uploadBatch(files));
+                }
+                batch = [];
+                batchBytes = 0;
+            };
+            
+            // 大文件单独上传，小文件打包
+            for (const entry of entries) {
+                if (entry.file.size >= this.smallFileSize) {
+                    tasks.push(() => this.uploadFile(entry.file, entry.path));
+                    continue;
+                }
+                
+                batch.push(entry);
+                batchBytes += entry.file.size;
+                if (batch.length >= this.batchMaxFiles || batchBytes >= this.batchMaxBytes) {
+                    flushBatch();
+                }
             }
+            flushBatch();
+            
+            await this.runWithConcurrency(tasks, this.uploadConcurrency);
+            
+            // 全部完成后刷新一次文件列表
+            await this.loadFileList();
         } catch (error) {
             console.error('处理文件选择时出错:', error);
             this.showMessage('文件处理失败', 'error');
         }
     }
     
-    async uploadFile(file) {
-        const fileId = 'upload_' + Date.now();
-        const startTime = Date.now();
+    async runWithConcurrency(tasks, limit) {
+        let next = 0;
+        const worker = async () => {
+            while (next < tasks.length) {
+                const task = tasks[next++];
+                await task();
+            }
+        };
+        const workers = Array.from({ length: Math.min(limit, tasks.length) }, worker);
+        await Promise.all(workers);
+    }
+    
+    createUploadItem(name, size) {
+        const fileId = `upload_${Date.now()}_${Math.random().toString(36).slice(2, 8)}`;
         
         // 创建上传记录
         const upload = {
             id: fileId,
-            file: file,
             progress: 0,
             uploaded: 0,
-            total: file.size,
-            startTime: startTime,
+            total: size,
+            startTime: Date.now(),
             chunks: [],
             status: 'uploading'
         };
@@ -484,17 +658,70 @@ class FileTransferApp {
         const item = clone.querySelector('.file-item');
         item.id = `upload-${fileId}`;
         
-        item.querySelector('.file-name').textContent = file.name;
-        item.querySelector('.file-size').textContent = this.formatFileSize(file.size);
+        item.querySelector('.file-name').textContent = name;
+        item.querySelector('.file-size').textContent = this.formatFileSize(size);
         item.querySelector('.file-date').textContent = '上传中...';
         
         filesList.prepend(item);
         
-        try {
-            // 创建FormData
-            const formData = new FormData();
-            formData.append('file', file);
+        return { fileId, upload, item };
+    }
+    
+    buildTarHeader(path, size, mtime, typeflag = '0') {
+        const encoder = new TextEncoder();
+        const header = new Uint8Array(512);
+        
+        const writeString = (offset, length, value) => {
+            header.set(encoder.encode(value).subarray(0, length), offset);
+        };
+        const writeOctal = (offset, length, value) => {
+            writeString(offset, length - 1, value.toString(8).padStart(length - 1, '0'));
+        };
+        
+        writeString(0, 100, path);
+        writeOctal(100, 8, 0o644);
+        writeOctal(108, 8, 0);
+        writeOctal(116, 8, 0);
+        writeOctal(124, 12, size);
+        writeOctal(136, 12, Math.floor(mtime / 1000));
+        writeString(148, 8, '        ');
+        writeString(156, 1, typeflag);
+        writeString(257, 6, 'ustar');
+        writeString(263, 2, '00');
+        
+        const checksum = header.reduce((sum, byte) => sum + byte, 0);
+        writeString(148, 7, checksum.toString(8).padStart(6, '0') + '\0');
+        return header;
+    }
+    
+    buildTarBlob(entries) {
+        const encoder = new TextEncoder();
+        const parts = [];
+        const pad = size => new Uint8Array((512 - size % 512) % 512);
+        
+        for (const { file, path } of entries) {
+            // 超过100字节的路径用pax扩展头记录
+            if (encoder.encode(path).length > 100) {
+                const body = ` path=${path}\n`;
+                const bodyLength = encoder.encode(body).length;
+                let length = bodyLength + 1;
+                while (length !== bodyLength + String(length).length) {
+                    length = bodyLength + String(length).length;
+                }
+                const record = encoder.encode(length + body);
+                parts.push(this.buildTarHeader('PaxHeader', record.length, file.lastModified, 'x'), record, pad(record.length));
+            }
             
+            // Blob只引用File，不会把文件内容读入内存
+            parts.push(this.buildTarHeader(path, file.size, file.lastModified), file, pad(file.size));
+        }
+        
+        parts.push(new Uint8Array(1024));  // 归档结束标记
+        return new Blob(parts, { type: 'application/x-tar' });
+    }
+    
+    sendWithProgress(url, body, fileId, upload) {
+        return new Promise((resolve, reject) => {
             // 创建XMLHttpRequest（支持进度监控）
             const xhr = new XMLHttpRequest();
             
@@ -510,36 +737,67 @@ class FileTransferApp {
             
             xhr.addEventListener('load', () => {
                 if (xhr.status === 200) {
-                    const response = JSON.parse(xhr.responseText);
-                    upload.status = 'completed';
-                    
-                    // 更新UI
-                    item.classList.add('completed');
-                    item.querySelector('.progress-text').textContent = '100%';
-                    item.querySelector('.file-date').textContent = '上传完成';
-                    
-                    // 重新加载文件列表
-                    this.loadFileList();
-                    
-                    // 显示成功消息
-                    this.showMessage(`文件 ${file.name} 上传成功`, 'success');
-                    
+                    resolve(JSON.parse(xhr.responseText));
                 } else {
-                    upload.status = 'error';
-                    item.querySelector('.file-date').textContent = '上传失败';
-                    this.showMessage(`文件 ${file.name} 上传失败`, 'error');
+                    reject(new Error(`HTTP ${xhr.status}`));
                 }
             });
             
-            xhr.addEventListener('error', () => {
-                upload.status = 'error';
-                item.querySelector('.file-date').textContent = '上传失败';
-                this.showMessage(`文件 ${file.name} 上传失败`, 'error');
-            });
+            xhr.addEventListener('error', () => reject(new Error('网络错误')));
+            
+            xhr.open('POST', url);
+            xhr.send(body);
+        });
+    }
+    
+    async uploadBatch(entries) {
+        const totalSize = entries.reduce((sum, entry) => sum + entry.file.size, 0);
+        const label = `${entries[0].path} 等 ${entries.length} 个文件`;
+        const { fileId, upload, item } = this.createUploadItem(label, totalSize);
+        
+        try {
+            const response = await this.sendWithProgress('/api/upload-tar', this.buildTarBlob(entries), fileId, upload);
+            upload.status = 'completed';
+            
+            // 更新UI
+            item.classList.add('completed');
+            item.querySelector('.progress-text').textContent = '100%';
+            item.querySelector('.file-date').textContent = '上传完成';
+            
+            if (response.skipped > 0) {
+                this.showMessage(`${response.files} 个文件上传成功，${response.skipped} 个无法保存已跳过`, 'info');
+            } else {
+                this.showMessage(`${response.files} 个文件上传成功`, 'success');
+            }
+            
+        } catch (error) {
+            console.error('批量上传失败:', error);
+            upload.status = 'error';
+            item.querySelector('.file-date').textContent = '上传失败';
+            this.showMessage(`${label} 上传失败`, 'error');
+        }
+    }
+    
+    async uploadFile(file, path = file.name) {
+        const { fileId, upload, item } = this.createUploadItem(path, file.size);
+        upload.file = file;
+        
+        try {
+            // 创建FormData，路径字段需在文件之前
+            const formData = new FormData();
+            formData.append('path', path);
+            formData.append('file', file);
+            
+            await this.sendWithProgress('/api/upload', formData, fileId, upload);
+            upload.status = 'completed';
+            
+            // 更新UI
+            item.classList.add('completed');
+            item.querySelector('.progress-text').textContent = '100%';
+            item.querySelector('.file-date').textContent = '上传完成';
             
-            // 开始上传
-            xhr.open('POST', '/api/upload');
-            xhr.send(formData);
+            // 显示成功消息
+            this.showMessage(`文件 ${file.name} 上传成功`, 'success');
             
         } catch (error) {
             console.error('上传失败:', error);
@@ -629,13 +887,15 @@ class FileTransferApp {
                 return;
             }
             
-            const response = await fetch(`/api/delete/${fileId}`, {
+            // 文件id是相对路径，逐段编码
+            const encodedId = fileId.split('/').map(encodeURIComponent).join('/');
+            const response = await fetch(`/api/delete/${encodedId}`, {
                 method: 'DELETE'
             });
             
             if (response.ok) {
                 // 从UI中移除
-                const item = document.querySelector(`[data-file-id="${fileId}"]`);
+                const item = document.querySelector(`[data-file-id="${CSS.escape(fileId)}"]`);
                 if (item) item.remove();
                 
                 this.showMessage('文件已删除', 'success');
@@ -0,0 +1,172 @@
+// 精简的MessagePack编解码，供WebSocket二进制协议（fileshare.v2.msgpack）使用
+// 支持nil、布尔、整数、浮点、字符串、二进制、数组和映射，不依赖外部CDN
+(function (global) {
+    const textEncoder = new TextEncoder();
+    const textDecoder = new TextDecoder();
+
+    function encode(value) {
+        const bytes = [];
+
+        const pushUint = (n, size) => {
+            for (let i = size - 1; i >= 0; i--) {
+                bytes.push(Math.floor(n / Math.pow(256, i)) % 256);
+            }
+        };
+
+        const pushFloat64 = (n) => {
+            const view = new DataView(new ArrayBuffer(8));
+            view.setFloat64(0, n);
+            bytes.push(0xcb, ...new Uint8Array(view.buffer));
+        };
+
+        const pushInt64 = (n) => {
+            const view = new DataView(new ArrayBuffer(8));
+            view.setBigInt64(0, BigInt(n));
+            bytes.push(0xd3, ...new Uint8Array(view.buffer));
+        };
+
+        const pushLength = (length, fix, fixMax, codes) => {
+            if (fix !== null && length <= fixMax) {
+                bytes.push(fix | length);
+            } else if (codes[0] !== null && length < 0x100) {
+                bytes.push(codes[0], length);
+            } else if (length < 0x10000) {
+                bytes.push(codes[1]);
+                pushUint(length, 2);
+            } else {
+                bytes.push(codes[2]);
+                pushUint(length, 4);
+            }
+        };
+
+        const write = (v) => {
+            if (v === null || v === undefined) {
+                bytes.push(0xc0);
+            } else if (v === false) {
+                bytes.push(0xc2);
+            } else if (v === true) {
+                bytes.push(0xc3);
+            } else if (typeof v === 'number') {
+                if (!Number.isSafeInteger(v)) {
+                    pushFloat64(v);
+                } else if (v >= 0) {
+                    if (v < 0x80) bytes.push(v);
+                    else if (v < 0x100) bytes.push(0xcc, v);
+                    else if (v < 0x10000) { bytes.push(0xcd); pushUint(v, 2); }
+                    else if (v < 0x100000000) { bytes.push(0xce); pushUint(v, 4); }
+                    else { bytes.push(0xcf); pushUint(v, 8); }
+                } else {
+                    if (v >= -0x20) bytes.push(v & 0xff);
+                    else if (v >= -0x80) bytes.push(0xd0, v & 0xff);
+                    else if (v >= -0x8000) { bytes.push(0xd1); pushUint(v + 0x10000, 2); }
+                    else if (v >= -0x80000000) { bytes.push(0xd2); pushUint(v + 0x100000000, 4); }
+                    else pushInt64(v);
+                }
+            } else if (typeof v === 'string') {
+                const encoded = textEncoder.encode(v);
+                pushLength(encoded.length, 0xa0, 31, [0xd9, 0xda, 0xdb]);
+                for (const byte of encoded) bytes.push(byte);
+            } else if (v instanceof Uint8Array) {
+                pushLength(v.length, null, 0, [0xc4, 0xc5, 0xc6]);
+                for (const byte of v) bytes.push(byte);
+            } else if (Array.isArray(v)) {
+                pushLength(v.length, 0x90, 15, [null, 0xdc, 0xdd]);
+                v.forEach(write);
+            } else if (typeof v === 'object') {
+                const keys = Object.keys(v).filter(key => v[key] !== undefined);
+                pushLength(keys.length, 0x80, 15, [null, 0xde, 0xdf]);
+                keys.forEach(key => {
+                    write(key);
+                    write(v[key]);
+                });
+            } else {
+                throw new TypeError(`无法编码的类型: ${typeof v}`);
+            }
+        };
+
+        write(value);
+        return new Uint8Array(bytes);
+    }
+
+    function decode(buffer) {
+        const data = buffer instanceof Uint8Array ? buffer : new Uint8Array(buffer);
+        const view = new DataView(data.buffer, data.byteOffset, data.byteLength);
+        let offset = 0;
+
+        const uint = (size) => {
+            let n = 0;
+            for (let i = 0; i < size; i++) n = n * 256 + data[offset++];
+            return n;
+        };
+        const int = (size) => {
+            const n = uint(size);
+            const limit = Math.pow(2, size * 8);
+            return n >= limit / 2 ? n - limit : n;
+        };
+        const str = (length) => {
+            const value = textDecoder.decode(data.subarray(offset, offset + length));
+            offset += length;
+            return value;
+        };
+        const bin = (length) => {
+            const value = data.slice(offset, offset + length);
+            offset += length;
+            return value;
+        };
+        const array = (length) => {
+            const value = [];
+            for (let i = 0; i < length; i++) value.push(read());
+            return value;
+        };
+        const map = (length) => {
+            const value = {};
+            for (let i = 0; i < length; i++) {
+                const key = read();
+                value[key] = read();
+            }
+            return value;
+        };
+
+        const read = () => {
+            const code = data[offset++];
+
+            if (code < 0x80) return code;
+            if (code < 0x90) return map(code & 0x0f);
+            if (code < 0xa0) return array(code & 0x0f);
+            if (code < 0xc0) return str(code & 0x1f);
+            if (code >= 0xe0) return code - 0x100;
+
+            switch (code) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: return bin(uint(1));
+                case 0xc5: return bin(uint(2));
+                case 0xc6: return bin(uint(4));
+                case 0xca: offset += 4; return view.getFloat32(offset - 4);
+                case 0xcb: offset += 8; return view.getFloat64(offset - 8);
+                case 0xcc: return uint(1);
+                case 0xcd: return uint(2);
+                case 0xce: return uint(4);
+                case 0xcf: offset += 8; return Number(view.getBigUint64(offset - 8));
+                case 0xd0: return int(1);
+                case 0xd1: return int(2);
+                case 0xd2: return int(4);
+                case 0xd3: offset += 8; return Number(view.getBigInt64(offset - 8));
+                case 0xd9: return str(uint(1));
+                case 0xda: return str(uint(2));
+                case 0xdb: return str(uint(4));
+                case 0xdc: return array(uint(2));
+                case 0xdd: return array(uint(4));
+                case 0xde: return map(uint(2));
+                case 0xdf: return map(uint(4));
+                default:
+                    throw new Error(`不支持的MessagePack类型: 0x${code.toString(16)}`);
+            }
+        };
+
+        return read();
+    }
+
+    global.MessagePack = { encode, decode };
+})(window);
@@ -1,3 +1,6 @@
+import time
+_STARTUP_T0 = time.perf_counter()  # 启动计时起点（--profile-startup）
+
 import asyncio
 import aiohttp
 from aiohttp import web
@@ -5,17 +8,16 @@ import socket
 import os
 import json
 from pathlib import Path
-import qrcode
 from io import BytesIO
 import base64
-import hashlib
-import time
-import webbrowser
-import platform
-import aiofiles
 from datetime import datetime
 import secrets
 import sys
+import argparse
+from urllib.parse import quote
+
+# qrcode/PIL、aiofiles、ssl 等较重的模块在首次使用时再导入，加快冷启动
+_IMPORTS_DONE = time.perf_counter()
 
 def resource_path(relative_path):
     """获取资源的绝对路径，适用于开发和打包后的环境"""
@@ -27,27 +29,222 @@ def resource_path(relative_path):
     
     return os.path.join(base_path, relative_path)
 
-def find_available_port(start_port=8888, max_attempts=100):
-    """查找可用的端口"""
+def bind_available_port(host='0.0.0.0', start_port=8888, max_attempts=100):
+    """绑定一个可用端口，返回已绑定的socket，直接交给服务器使用"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if os.name != 'nt':
+        # Windows上SO_REUSEADDR允许抢占已占用端口，不能设置
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    
     for port in range(start_port, start_port + max_attempts):
         try:
-            # 尝试绑定端口
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.bind(('0.0.0.0', port))
-            sock.close()
-            return port
+            sock.bind((host, port))
+            return sock
         except OSError:
             continue
-    return start_port  # 如果找不到可用端口，返回起始端口
+    
+    # 范围内都被占用，由系统分配一个空闲端口
+    sock.bind((host, 0))
+    return sock
+
+# Windows保留的设备名（不区分大小写，带扩展名也不行，如CON.txt）
+WINDOWS_RESERVED_NAMES = {'CON', 'PRN', 'AUX', 'NUL'} | {
+    f'{device}{n}' for device in ('COM', 'LPT') for n in '0123456789¹²³'
+}
+
+def safe_relative_path(path):
+    """清理客户端提供的相对路径，去掉..、盘符、非法字符和Windows设备名，无效时返回None"""
+    parts = []
+    for part in str(path).replace('\\', '/').split('/'):
+        # 去掉控制字符和Windows文件名中不允许的字符，末尾的点和空格在Windows上也无效
+        part = ''.join(c for c in part if c >= ' ' and c not in '<>:"|?*').strip().rstrip('. ')
+        # 设备名加前缀，避免在Windows上写入设备文件
+        if part.split('.', 1)[0].rstrip(' ').upper() in WINDOWS_RESERVED_NAMES:
+            part = '_' + part
+        if part:
+            parts.append(part)
+    return '/'.join(parts) or None
+
+def parse_tar_header(header):
+    """解析512字节的tar头，返回(路径, 大小, 类型)，校验和错误时抛出ValueError"""
+    stored_checksum = int(header[148:156].split(b'\0', 1)[0].strip() or b'0', 8)
+    if stored_checksum != sum(header[:148]) + 8 * 32 + sum(header[156:]):
+        raise ValueError('tar头校验和错误')
+    
+    name = header[0:100].split(b'\0', 1)[0]
+    if header[257:262] == b'ustar':
+        prefix = header[345:500].split(b'\0', 1)[0]
+        if prefix:
+            name = prefix + b'/' + name
+    
+    size_field = header[124:136]
+    if size_field[0] & 0x80:
+        # GNU base-256编码，用于超过8GB的文件
+        size = int.from_bytes(size_field[1:], 'big')
+    else:
+        size = int(size_field.split(b'\0', 1)[0].strip() or b'0', 8)
+    
+    return name.decode('utf-8', 'replace'), size, header[156:157]
+
+def load_msgpack():
+    """按需导入msgpack，未安装时返回None"""
+    try:
+        import msgpack
+        return msgpack
+    except ImportError:
+        return None
+
+def ensure_self_signed_cert(cert_dir, hostnames=()):
+    """确保存在覆盖hostnames的自签名证书，返回(证书路径, 私钥路径)
+    
+    证书包含的名称记录在server.names中。局域网IP变化（如DHCP重新分配、切换网络）后
+    用原私钥重新签发，名称只增不减，在几个网络之间来回切换不会反复重新生成。
+    """
+    cert_dir = Path(cert_dir)
+    cert_dir.mkdir(exist_ok=True)
+    cert_file = cert_dir / 'server.crt'
+    key_file = cert_dir / 'server.key'
+    names_file = cert_dir / 'server.names'
+    
+    requested = ['localhost', '127.0.0.1'] + [h for h in hostnames if h]
+    
+    try:
+        cert_names = json.loads(names_file.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        cert_names = []
+    
+    if cert_file.exists() and key_file.exists() and set(requested) <= set(cert_names):
+        return cert_file, key_file
+    
+    # 保留旧证书中的名称，只追加新地址
+    names = []
+    for name in cert_names + requested:
+        if name not in names:
+            names.append(name)
+    
+    reuse_key = key_file.exists()
+    
+    try:
+        # 优先使用cryptography生成证书
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+        import datetime as dt
+        import ipaddress
+        
+        if reuse_key:
+            key = serialization.load_pem_private_key(key_file.read_bytes(), password=None)
+        else:
+            key = ec.generate_private_key(ec.SECP256R1())
+        subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'fileshare')])
+        
+        alt_names = []
+        for name in names:
+            try:
+                alt_names.append(x509.IPAddress(ipaddress.ip_address(name)))
+            except ValueError:
+                alt_names.append(x509.DNSName(name))
+        
+        now = dt.datetime.now(dt.timezone.utc)
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - dt.timedelta(days=1))
+            .not_valid_after(now + dt.timedelta(days=825))
+            .add_extension(x509.SubjectAlternativeName(alt_names), critical=False)
+            # iOS 13+/macOS 10.15+要求服务器证书带serverAuth用途，且不能是CA证书
+            .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH]), critical=False)
+            .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+            .sign(key, hashes.SHA256())
+        )
+        
+        if not reuse_key:
+            key_file.write_bytes(key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.TraditionalOpenSSL,
+                serialization.NoEncryption()
+            ))
+        cert_file.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+        
+    except ImportError:
+        # 没有cryptography时退回到openssl命令行
+        import subprocess
+        
+        san = ','.join(
+            f"IP:{name}" if name.replace('.', '').isdigit() else f"DNS:{name}"
+            for name in names
+        )
+        if reuse_key:
+            key_args = ['-key', str(key_file)]
+        else:
+            key_args = ['-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-keyout', str(key_file)]
+        subprocess.run([
+            'openssl', 'req', '-x509', '-nodes', *key_args,
+            '-days', '825', '-subj', '/CN=fileshare',
+            '-addext', f'subjectAltName={san}',
+            '-addext', 'extendedKeyUsage=serverAuth',
+            '-addext', 'basicConstraints=critical,CA:FALSE',
+            '-out', str(cert_file)
+        ], check=True, capture_output=True)
+    
+    try:
+        os.chmod(key_file, 0o600)
+    except OSError:
+        pass
+    
+    names_file.write_text(json.dumps(names), encoding='utf-8')
+    
+    if cert_names:
+        print(f"🔐 证书已重新签发（新增地址: {', '.join(n for n in names if n not in cert_names)}）: {cert_file.absolute()}")
+        print("🔐 各设备需要重新信任该证书；如使用了反向代理，请重启代理以加载新证书")
+    else:
+        print(f"🔐 已生成自签名证书: {cert_file.absolute()}")
+    return cert_file, key_file
+
+def create_ssl_context(cert_file, key_file):
+    """创建服务器端SSL上下文"""
+    import ssl
+    
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(str(cert_file), str(key_file))
+    # aiohttp只实现了HTTP/1.1，HTTP/2需要由前置代理协商
+    context.set_alpn_protocols(['http/1.1'])
+    return context
 
 class FileTransferServer:
-    def __init__(self, host='0.0.0.0', port=8888):
+    # 协商后的WebSocket协议：事件批量合并、历史按序号增量同步
+    WS_PROTOCOL_MSGPACK = 'fileshare.v2.msgpack'
+    WS_PROTOCOL_JSON = 'fileshare.v2.json'
+    WS_BATCH_WINDOW = 0.02  # 事件合并窗口（秒）
+    WS_INITIAL_HISTORY = 20  # 首次连接（或服务器重启后）发送的历史条数，与旧协议一致
+    WS_HISTORY_LIMIT = 200  # 断线重连时最多补发的历史条数
+    
+    def __init__(self, host='0.0.0.0', port=8888, use_https=False, profile_startup=False,
+                 public_url=None):
+        init_start = time.perf_counter()
         self.host = host
         self.port = port
+        self.use_https = use_https
+        self.scheme = 'https' if use_https else 'http'
+        # 前置反向代理（如HTTP/2代理）时对外公布的地址，用于二维码和打开浏览器
+        self.public_url = public_url.rstrip('/') if public_url else None
+        self.ssl_context = None
+        self.profile_startup = profile_startup
+        self.startup_timings = [('模块导入', _IMPORTS_DONE - _STARTUP_T0)]
+        self.history_task = None
+        self.qr_cache = {}  # room_url -> base64二维码
         self.clients = {}
         self.transfers = {}
         self.chat_history = []
+        self.chat_seq = 0  # 聊天消息序号，供客户端增量同步
+        self.ws_epoch = secrets.token_hex(4)  # 每次启动不同，客户端据此判断序号是否仍然有效
+        self.ws_pending = []  # 等待合并发送的事件
+        self.ws_flush_task = None
         self.ip_to_name = {}  # 映射IP到用户名
         self.user_counter = 1  # 用户编号计数器
         self.app = web.Application()
@@ -69,16 +266,17 @@ class FileTransferServer:
         
         self.upload_dir = Path(base_dir) / 'uploads'
         self.chat_dir = Path(base_dir) / 'chat'
+        self.cert_dir = Path(base_dir) / 'cert'
         self.upload_dir.mkdir(exist_ok=True)
         self.chat_dir.mkdir(exist_ok=True)
         
         # 聊天文件路径
         self.chat_file = self.chat_dir / f"chat_{datetime.now().strftime('%Y%m%d')}.txt"
         
-        # 从文件加载历史聊天记录
-        self.load_chat_history()
+        # 历史聊天记录在服务器开始监听后于后台加载，见run()
         
         self.setup_routes()
+        self.startup_timings.append(('服务器初始化', time.perf_counter() - init_start))
     
     def setup_routes(self):
         """设置路由"""
@@ -96,8 +294,9 @@ class FileTransferServer:
             self.app.router.add_get('/api/room-info', self.handle_room_info)
             self.app.router.add_get('/api/files', self.handle_list_files)
             self.app.router.add_post('/api/upload', self.handle_upload_chunk)
-            self.app.router.add_get('/api/download/{file_id}', self.handle_download)
-            self.app.router.add_delete('/api/delete/{file_id}', self.handle_delete)
+            self.app.router.add_post('/api/upload-tar', self.handle_upload_tar)
+            self.app.router.add_get('/api/download/{file_id:.+}', self.handle_download)
+            self.app.router.add_delete('/api/delete/{file_id:.+}', self.handle_delete)
             
             # 聊天API
             self.app.router.add_get('/api/chat/history', self.handle_chat_history)
@@ -109,6 +308,7 @@ class FileTransferServer:
             # 直接访问CSS和JS
             self.app.router.add_get('/style.css', self.handle_css)
             self.app.router.add_get('/app.js', self.handle_js)
+            self.app.router.add_get('/msgpack.js', self.handle_msgpack_js)
             
         except Exception as e:
             print(f"设置路由时出错: {e}")
@@ -237,31 +437,47 @@ class FileTransferServer:
             print(f"处理JS请求时出错: {e}")
             return web.Response(text='// 错误', content_type='application/javascript')
     
+    async def handle_msgpack_js(self, request):
+        """处理MessagePack编解码脚本（随程序分发，不依赖CDN）"""
+        try:
+            possible_paths = [
+                self.resource_dir / 'client' / 'msgpack.js',
+                Path('client/msgpack.js'),
+            ]
+            
+            for js_path in possible_paths:
+                if js_path.exists():
+                    return web.FileResponse(str(js_path))
+            
+            # 找不到时客户端自动使用JSON协议
+            return web.Response(text='// msgpack.js未找到', content_type='application/javascript')
+            
+        except Exception as e:
+            print(f"处理msgpack.js请求时出错: {e}")
+            return web.Response(text='// 错误', content_type='application/javascript')
+    
     async def handle_room_info(self, request):
         """获取房间信息"""
         try:
-            local_ip = self.get_local_ip()
-            room_url = f"http://{local_ip}:{self.port}"
-            
-            # 生成二维码
-            qr = qrcode.QRCode(version=1, box_size=10, border=5)
-            qr.add_data(room_url)
-            qr.make(fit=True)
-            img = qr.make_image(fill_color="black", back_color="white")
+            if self.public_url:
+                room_url = self.public_url
+            else:
+                local_ip = self.get_local_ip()
+                room_url = f"{self.scheme}://{local_ip}:{self.port}"
             
-            buffered = BytesIO()
-            img.save(buffered, format="PNG")
-            qr_base64 = base64.b64encode(buffered.getvalue()).decode()
+            # 生成二维码（同一地址只生成一次）
+            qr_base64 = self.qr_cache.get(room_url)
+            if qr_base64 is None:
+                qr_base64 = await asyncio.get_running_loop().run_in_executor(
+                    None, self.make_qr_code, room_url
+                )
+                self.qr_cache[room_url] = qr_base64
             
             # 获取文件列表
-            files = []
-            for file_path in self.upload_dir.glob('*'):
-                if file_path.is_file():
-                    files.append({
-                        'name': file_path.name,
-                        'size': file_path.stat().st_size,
-                        'modified': file_path.stat().st_mtime
-                    })
+            files = [
+                {'name': f['name'], 'size': f['size'], 'modified': f['modified']}
+                for f in self.list_upload_files()
+            ]
             
             return web.json_response({
                 'room_url': room_url,
@@ -275,39 +491,86 @@ class FileTransferServer:
             print(f"处理房间信息请求时出错: {e}")
             return web.json_response({'error': str(e)}, status=500)
     
+    def make_qr_code(self, data):
+        """生成二维码PNG的base64编码"""
+        import qrcode
+        
+        qr = qrcode.QRCode(version=1, box_size=10, border=5)
+        qr.add_data(data)
+        qr.make(fit=True)
+        img = qr.make_image(fill_color="black", back_color="white")
+        
+        buffered = BytesIO()
+        img.save(buffered, format="PNG")
+        return base64.b64encode(buffered.getvalue()).decode()
+    
     async def handle_list_files(self, request):
         """获取文件列表"""
         try:
-            files = []
-            for file_path in self.upload_dir.glob('*'):
-                if file_path.is_file():
-                    files.append({
-                        'id': file_path.name,
-                        'name': file_path.name,
-                        'size': file_path.stat().st_size,
-                        'modified': file_path.stat().st_mtime,
-                        'url': f'/api/download/{file_path.name}'
-                    })
-            
-            return web.json_response({'files': files})
+            return web.json_response({'files': self.list_upload_files()})
         except Exception as e:
             print(f"处理文件列表请求时出错: {e}")
             return web.json_response({'error': str(e)}, status=500)
     
+    def list_upload_files(self):
+        """列出上传目录（含子目录）中的所有文件，id为相对路径"""
+        files = []
+        for file_path in sorted(self.upload_dir.rglob('*')):
+            if file_path.is_file():
+                stat = file_path.stat()
+                relative = file_path.relative_to(self.upload_dir).as_posix()
+                files.append({
+                    'id': relative,
+                    'name': file_path.name,
+                    'path': relative,
+                    'size': stat.st_size,
+                    'modified': stat.st_mtime,
+                    'url': f'/api/download/{quote(relative)}'
+                })
+        return files
+    
+    def resolve_upload_path(self, relative_path):
+        """把客户端路径映射到上传目录内，越界或无效时返回None"""
+        relative_path = safe_relative_path(relative_path)
+        if relative_path is None:
+            return None
+        
+        file_path = self.upload_dir.joinpath(*relative_path.split('/'))
+        try:
+            file_path.resolve().relative_to(self.upload_dir.resolve())
+        except ValueError:
+            return None
+        return file_path
+    
     async def handle_upload_chunk(self, request):
         """处理文件上传"""
         try:
             reader = await request.multipart()
+            
+            # 可选的path字段（文件夹上传时的相对路径）需在file字段之前
+            relative_path = None
             file_field = await reader.next()
+            while file_field is not None and file_field.name == 'path':
+                relative_path = await file_field.text()
+                file_field = await reader.next()
             
             if file_field is None:
                 return web.json_response({'error': '没有文件'}, status=400)
             
-            filename = file_field.filename
-            file_id = hashlib.md5(f"{filename}{time.time()}".encode()).hexdigest()[:8]
+            relative_path = relative_path or file_field.filename
+            if not relative_path:
+                return web.json_response({'error': '缺少文件名'}, status=400)
+            
+            file_path = self.resolve_upload_path(relative_path)
+            if file_path is None:
+                return web.json_response({'error': '无效的文件路径'}, status=400)
+            
+            filename = file_path.relative_to(self.upload_dir).as_posix()
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            
+            import aiofiles
             
             # 保存文件
-            file_path = self.upload_dir / filename
             size = 0
             
             async with aiofiles.open(file_path, 'wb') as f:
@@ -322,26 +585,136 @@ class FileTransferServer:
                 'success': True,
                 'filename': filename,
                 'size': size,
-                'url': f'/api/download/{filename}'
+                'url': f'/api/download/{quote(filename)}'
             })
             
         except Exception as e:
             print(f"处理文件上传时出错: {e}")
             return web.json_response({'error': str(e)}, status=500)
     
+    async def handle_upload_tar(self, request):
+        """批量上传：边接收边解包tar流，保留目录结构"""
+        try:
+            import aiofiles
+            
+            stream = request.content
+            loop = asyncio.get_running_loop()
+            chunk_size = 1024 * 1024  # 1MB chunks
+            saved = 0
+            total_size = 0
+            skipped = 0
+            long_path = None  # GNU长文件名或pax头中的路径，作用于下一个条目
+            
+            async def skip(remaining):
+                """分块丢弃条目数据，不把声明的整个大小读入内存"""
+                while remaining > 0:
+                    remaining -= len(await stream.readexactly(min(chunk_size, remaining)))
+            
+            while True:
+                try:
+                    header = await stream.readexactly(512)
+                except asyncio.IncompleteReadError as e:
+                    if e.partial:
+                        return web.json_response({'error': 'tar数据不完整'}, status=400)
+                    break
+                
+                # 全零块表示归档结束
+                if header == bytes(512):
+                    break
+                
+                try:
+                    name, size, typeflag = parse_tar_header(header)
+                except ValueError as e:
+                    return web.json_response({'error': str(e)}, status=400)
+                
+                padding = -size % 512
+                
+                # 扩展头：读取路径，作用于下一个条目
+                if typeflag in (b'L', b'x', b'g'):
+                    if size > chunk_size:
+                        return web.json_response({'error': 'tar扩展头过大'}, status=400)
+                    data = (await stream.readexactly(size + padding))[:size]
+                    if typeflag == b'L':
+                        long_path = data.split(b'\0', 1)[0].decode('utf-8', 'replace')
+                    elif typeflag == b'x':
+                        for record in data.decode('utf-8', 'replace').split('\n'):
+                            key, _, value = record.partition(' ')[2].partition('=')
+                            if key == 'path':
+                                long_path = value
+                    continue
+                
+                path, long_path = long_path or name, None
+                file_path = self.resolve_upload_path(path)
+                
+                if typeflag == b'5':
+                    # 目录
+                    if file_path is not None:
+                        try:
+                            file_path.mkdir(parents=True, exist_ok=True)
+                        except OSError as e:
+                            print(f"创建目录 {path} 失败: {e}")
+                            skipped += 1
+                    await skip(size + padding)
+                    continue
+                
+                if typeflag not in (b'0', b'\0', b'7') or file_path is None:
+                    # 链接、设备文件等不处理，路径无效的也跳过
+                    skipped += 1
+                    await skip(size + padding)
+                    continue
+                
+                # 单个条目写入失败（如与已有文件/目录冲突）只跳过该条目，不影响同批其他文件
+                remaining = size
+                try:
+                    file_path.parent.mkdir(parents=True, exist_ok=True)
+                    
+                    if size <= chunk_size:
+                        # 小文件一次写入，减少线程切换
+                        data = await stream.readexactly(size)
+                        remaining = 0
+                        await loop.run_in_executor(None, file_path.write_bytes, data)
+                    else:
+                        async with aiofiles.open(file_path, 'wb') as f:
+                            while remaining > 0:
+                                chunk = await stream.readexactly(min(chunk_size, remaining))
+                                remaining -= len(chunk)
+                                await f.write(chunk)
+                except OSError as e:
+                    print(f"保存 {path} 失败: {e}")
+                    skipped += 1
+                    await skip(remaining + padding)
+                    continue
+                
+                await stream.readexactly(padding)
+                saved += 1
+                total_size += size
+            
+            return web.json_response({
+                'success': True,
+                'files': saved,
+                'skipped': skipped,
+                'size': total_size
+            })
+            
+        except asyncio.IncompleteReadError:
+            return web.json_response({'error': 'tar数据不完整'}, status=400)
+        except Exception as e:
+            print(f"处理批量上传时出错: {e}")
+            return web.json_response({'error': str(e)}, status=500)
+    
     async def handle_download(self, request):
         """处理文件下载"""
         try:
             file_id = request.match_info.get('file_id')
-            file_path = self.upload_dir / file_id
+            file_path = self.resolve_upload_path(file_id)
             
-            if not file_path.exists():
+            if file_path is None or not file_path.is_file():
                 return web.Response(text='文件不存在', status=404)
             
             # 支持断点续传
             headers = {
                 'Content-Type': 'application/octet-stream',
-                'Content-Disposition': f'attachment; filename="{file_id}"'
+                'Content-Disposition': f"attachment; filename*=UTF-8''{quote(file_path.name)}"
             }
             
             # 检查Range请求
@@ -357,6 +730,8 @@ class FileTransferServer:
                 headers['Content-Length'] = str(range_end - range_start)
                 headers['Accept-Ranges'] = 'bytes'
                 
+                import aiofiles
+                
                 async with aiofiles.open(file_path, 'rb') as f:
                     await f.seek(range_start)
                     chunk_size = 1024 * 1024  # 1MB chunks
@@ -406,10 +781,20 @@ class FileTransferServer:
         """删除文件"""
         try:
             file_id = request.match_info.get('file_id')
-            file_path = self.upload_dir / file_id
+            file_path = self.resolve_upload_path(file_id)
             
-            if file_path.exists():
+            if file_path is not None and file_path.is_file():
                 file_path.unlink()
+                
+                # 清理删除后变空的子目录
+                parent = file_path.parent
+                try:
+                    while parent != self.upload_dir and not any(parent.iterdir()):
+                        parent.rmdir()
+                        parent = parent.parent
+                except OSError:
+                    pass  # 目录中又写入了新文件等情况，停止清理
+                
                 return web.json_response({'success': True})
             
             return web.json_response({'error': '文件不存在'}, status=404)
@@ -421,6 +806,7 @@ class FileTransferServer:
     async def handle_chat_history(self, request):
         """获取聊天历史"""
         try:
+            await self.wait_chat_history()
             return web.json_response({
                 'messages': self.chat_history[-50:]  # 返回最近50条消息
             })
@@ -438,6 +824,9 @@ class FileTransferServer:
             if not message:
                 return web.json_response({'error': '消息不能为空'}, status=400)
             
+            # 等历史记录加载完，历史中的IP先编号
+            await self.wait_chat_history()
+            
             # 为IP分配用户名（按照发消息顺序）
             if client_ip not in self.ip_to_name:
                 self.ip_to_name[client_ip] = f"用户{self.user_counter}"
@@ -456,7 +845,7 @@ class FileTransferServer:
             }
             
             # 添加到历史记录
-            self.chat_history.append(chat_message)
+            await self.append_chat_message(chat_message)
             
             # 保存到文件
             await self.save_chat_message(chat_message)
@@ -475,13 +864,23 @@ class FileTransferServer:
     
     async def handle_websocket(self, request):
         """WebSocket连接"""
-        ws = web.WebSocketResponse()
+        msgpack = load_msgpack()
+        protocols = [self.WS_PROTOCOL_JSON]
+        if msgpack is not None:
+            protocols.insert(0, self.WS_PROTOCOL_MSGPACK)
+        
+        # 未协商子协议的旧客户端沿用原有的JSON消息格式
+        ws = web.WebSocketResponse(protocols=protocols)
         try:
             await ws.prepare(request)
+            protocol = ws.ws_protocol
             
             client_id = f"client_{int(time.time() * 1000)}_{secrets.token_hex(4)}"
             client_ip = request.remote
             
+            # 等历史记录加载完，历史中的IP先编号
+            await self.wait_chat_history()
+            
             # 为IP分配用户名（如果还没有分配）
             if client_ip not in self.ip_to_name:
                 self.ip_to_name[client_ip] = f"用户{self.user_counter}"
@@ -489,22 +888,56 @@ class FileTransferServer:
             
             client_name = self.ip_to_name[client_ip]
             
-            self.clients[client_id] = {
+            # 准备欢迎消息和聊天历史
+            if protocol is None:
+                welcome = json.dumps({
+                    'type': 'welcome',
+                    'client_id': client_id,
+                    'client_name': client_name,
+                    'chat_history': self.chat_history[-20:]  # 发送最近20条消息
+                })
+            else:
+                # 从客户端最后收到的序号开始补发，服务器重启后序号失效则从头开始
+                try:
+                    since = int(request.query.get('since', 0))
+                except ValueError:
+                    since = 0
+                if request.query.get('epoch') != self.ws_epoch:
+                    since = 0
+                
+                if since > 0:
+                    history = self.chat_history_since(since)
+                else:
+                    history = self.chat_history[-self.WS_INITIAL_HISTORY:]
+                
+                welcome = self.encode_ws_frame(protocol, {
+                    'type': 'welcome',
+                    'client_id': client_id,
+                    'client_name': client_name,
+                    'epoch': self.ws_epoch,
+                    'last_seq': self.chat_seq,
+                    'chat_history': [self.compact_chat_message(m) for m in history]
+                })
+            
+            # 生成欢迎消息后立即登记（中间没有await），之后的广播不会遗漏；
+            # 欢迎消息发出前的广播先暂存在backlog中，保证欢迎消息是第一帧
+            client = {
                 'ws': ws,
                 'ip': client_ip,
                 'name': client_name,
-                'connected_at': time.time()
+                'protocol': protocol,
+                'connected_at': time.time(),
+                'ready': False,
+                'backlog': []
             }
+            self.clients[client_id] = client
             
             print(f"客户端 {client_id} 已连接 ({client_ip} - {client_name})")
             
-            # 发送欢迎消息和聊天历史
-            await ws.send_json({
-                'type': 'welcome',
-                'client_id': client_id,
-                'client_name': client_name,
-                'chat_history': self.chat_history[-20:]  # 发送最近20条消息
-            })
+            await self.send_ws_frame(ws, protocol, welcome)
+            while client['backlog']:
+                await self.send_ws_frame(ws, protocol, client['backlog'].pop(0))
+            client['ready'] = True
             
             async for msg in ws:
                 if msg.type == aiohttp.WSMsgType.TEXT:
@@ -515,6 +948,12 @@ class FileTransferServer:
                         print(f"无法解析JSON: {msg.data}")
                     except Exception as e:
                         print(f"处理WebSocket消息时出错: {e}")
+                elif msg.type == aiohttp.WSMsgType.BINARY and protocol == self.WS_PROTOCOL_MSGPACK:
+                    try:
+                        data = msgpack.unpackb(msg.data, raw=False)
+                        await self.handle_websocket_message(client_id, data)
+                    except Exception as e:
+                        print(f"处理WebSocket消息时出错: {e}")
                 elif msg.type == aiohttp.WSMsgType.ERROR:
                     print(f'WebSocket错误: {ws.exception()}')
                     break
@@ -551,7 +990,7 @@ class FileTransferServer:
                     }
                     
                     # 添加到历史记录
-                    self.chat_history.append(chat_message)
+                    await self.append_chat_message(chat_message)
                     
                     # 保存到文件
                     await self.save_chat_message(chat_message)
@@ -564,16 +1003,22 @@ class FileTransferServer:
     async def broadcast_chat_message(self, message):
         """广播聊天消息给所有客户端"""
         try:
-            broadcast_data = {
+            # 旧协议客户端立即收到完整消息，只序列化一次
+            broadcast_data = json.dumps({
                 'type': 'chat_message',
                 'message': message
-            }
+            })
             
             disconnected_clients = []
             
-            for client_id, client in self.clients.items():
+            for client_id, client in list(self.clients.items()):
+                if client.get('protocol') is not None:
+                    continue
+                if not client['ready']:
+                    client['backlog'].append(broadcast_data)
+                    continue
                 try:
-                    await client['ws'].send_json(broadcast_data)
+                    await client['ws'].send_str(broadcast_data)
                 except:
                     disconnected_clients.append(client_id)
             
@@ -581,9 +1026,93 @@ class FileTransferServer:
             for client_id in disconnected_clients:
                 if client_id in self.clients:
                     del self.clients[client_id]
+            
+            # 新协议客户端在合并窗口结束后批量接收
+            self.queue_ws_event({
+                'type': 'chat_message',
+                'message': self.compact_chat_message(message)
+            })
         except Exception as e:
             print(f"广播聊天消息时出错: {e}")
     
+    def queue_ws_event(self, event):
+        """加入待发送事件，合并窗口内的事件打包成一帧发送"""
+        self.ws_pending.append(event)
+        if self.ws_flush_task is None:
+            self.ws_flush_task = asyncio.create_task(self.flush_ws_events())
+    
+    async def flush_ws_events(self):
+        """合并窗口结束后把事件批量发送给新协议客户端"""
+        await asyncio.sleep(self.WS_BATCH_WINDOW)
+        
+        events, self.ws_pending = self.ws_pending, []
+        self.ws_flush_task = None
+        
+        try:
+            frames = {}  # 每种协议只编码一次
+            disconnected_clients = []
+            
+            for client_id, client in list(self.clients.items()):
+                protocol = client.get('protocol')
+                if protocol is None:
+                    continue
+                
+                if protocol not in frames:
+                    frames[protocol] = self.encode_ws_frame(protocol, {'type': 'batch', 'events': events})
+                
+                if not client['ready']:
+                    client['backlog'].append(frames[protocol])
+                    continue
+                
+                try:
+                    await self.send_ws_frame(client['ws'], protocol, frames[protocol])
+                except:
+                    disconnected_clients.append(client_id)
+            
+            # 清理断开连接的客户端
+            for client_id in disconnected_clients:
+                if client_id in self.clients:
+                    del self.clients[client_id]
+        except Exception as e:
+            print(f"批量发送WebSocket事件时出错: {e}")
+    
+    def encode_ws_frame(self, protocol, data):
+        """按协商的协议编码消息"""
+        if protocol == self.WS_PROTOCOL_MSGPACK:
+            return load_msgpack().packb(data, use_bin_type=True)
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    
+    async def send_ws_frame(self, ws, protocol, frame):
+        """发送已编码的消息"""
+        if protocol == self.WS_PROTOCOL_MSGPACK:
+            await ws.send_bytes(frame)
+        else:
+            await ws.send_str(frame)
+    
+    def compact_chat_message(self, message):
+        """新协议使用的精简消息，不含IP和格式化时间"""
+        return {
+            'seq': message.get('seq', 0),
+            'id': message['id'],
+            'message': message['message'],
+            'client_name': message['client_name'],
+            'timestamp': message['timestamp']
+        }
+    
+    async def append_chat_message(self, message):
+        """添加消息到历史记录并分配序号（等历史加载完成，已发出的序号不会再变）"""
+        await self.wait_chat_history()
+        self.chat_seq += 1
+        message['seq'] = self.chat_seq
+        self.chat_history.append(message)
+    
+    def chat_history_since(self, since):
+        """返回序号大于since的历史消息（最多WS_HISTORY_LIMIT条）"""
+        start = len(self.chat_history)
+        while start > 0 and self.chat_history[start - 1].get('seq', 0) > since:
+            start -= 1
+        return self.chat_history[max(start, len(self.chat_history) - self.WS_HISTORY_LIMIT):]
+    
     async def save_chat_message(self, message):
         """保存聊天消息到文件"""
         try:
@@ -591,49 +1120,89 @@ class FileTransferServer:
             # xxxxxxx
             log_line = f"{message['client_ip']} {message['time_str']}\n{message['message']}\n\n"
             
+            import aiofiles
+            
             async with aiofiles.open(self.chat_file, 'a', encoding='utf-8') as f:
                 await f.write(log_line)
                 
         except Exception as e:
             print(f"保存聊天消息失败: {e}")
     
-    def load_chat_history(self):
+    def read_chat_file(self):
+        """读取并解析聊天文件，返回(序号, IP, 时间, 消息)列表（在线程池中执行）"""
+        entries = []
+        if not self.chat_file.exists():
+            return entries
+        
+        with open(self.chat_file, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        
+        # 解析聊天记录
+        for i in range(0, len(lines), 3):
+            if i + 2 < len(lines):
+                header = lines[i].strip()
+                message = lines[i+1].strip()
+                
+                if header and message:
+                    # 解析头部信息
+                    parts = header.split(' ', 1)
+                    if len(parts) == 2:
+                        ip, timestamp = parts
+                        entries.append((i, ip, timestamp, message))
+        
+        return entries
+    
+    async def load_chat_history(self):
         """从文件加载聊天历史"""
+        start = time.perf_counter()
         try:
-            if self.chat_file.exists():
-                with open(self.chat_file, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                    
-                # 解析聊天记录
-                for i in range(0, len(lines), 3):
-                    if i + 2 < len(lines):
-                        header = lines[i].strip()
-                        message = lines[i+1].strip()
-                        
-                        if header and message:
-                            # 解析头部信息
-                            parts = header.split(' ', 1)
-                            if len(parts) == 2:
-                                ip, timestamp = parts
-                                
-                                # 为IP分配用户名（如果还没有分配）
-                                if ip not in self.ip_to_name:
-                                    self.ip_to_name[ip] = f"用户{self.user_counter}"
-                                    self.user_counter += 1
-                                
-                                client_name = self.ip_to_name[ip]
-                                
-                                self.chat_history.append({
-                                    'id': f"hist_{i}",
-                                    'message': message,
-                                    'client_ip': ip,
-                                    'client_name': client_name,
-                                    'timestamp': time.time() - (len(self.chat_history) * 10),
-                                    'time_str': timestamp
-                                })
-                                
+            entries = await asyncio.get_running_loop().run_in_executor(None, self.read_chat_file)
+            
+            history = []
+            now = time.time()
+            for i, ip, timestamp, message in entries:
+                # 为IP分配用户名（如果还没有分配）
+                if ip not in self.ip_to_name:
+                    self.ip_to_name[ip] = f"用户{self.user_counter}"
+                    self.user_counter += 1
+                
+                # 新协议只传timestamp，需要用文件中记录的真实时间
+                try:
+                    message_time = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').timestamp()
+                except ValueError:
+                    message_time = now - (len(history) * 10)
+                
+                history.append({
+                    'id': f"hist_{i}",
+                    'message': message,
+                    'client_ip': ip,
+                    'client_name': self.ip_to_name[ip],
+                    'timestamp': message_time,
+                    'time_str': timestamp
+                })
+            
+            # 新消息要等加载完成才会写入（见append_chat_message），历史占用序号1..n
+            for seq, chat_message in enumerate(history, 1):
+                chat_message['seq'] = seq
+            self.chat_history[:0] = history
+            self.chat_seq = len(history)
+            
         except Exception as e:
             print(f"加载聊天历史失败: {e}")
+        finally:
+            self.startup_timings.append(('加载聊天历史', time.perf_counter() - start))
+    
+    async def wait_chat_history(self):
+        """等待后台历史记录加载完成"""
+        if self.history_task is not None:
+            await asyncio.shield(self.history_task)
+    
+    def print_startup_profile(self):
+        """输出启动各阶段耗时"""
+        print("⏱️  启动耗时:")
+        for label, seconds in self.startup_timings:
+            print(f"   {label:<12} {seconds * 1000:8.1f} ms")
+        print(f"   {'总计':<12} {(time.perf_counter() - _STARTUP_T0) * 1000:8.1f} ms")
     
     def get_local_ip(self):
         """获取本机IP地址"""
@@ -651,13 +1220,13 @@ class FileTransferServer:
     
     def open_browser(self):
         """自动打开浏览器"""
-        url = f"http://localhost:{self.port}"
+        url = self.public_url or f"{self.scheme}://localhost:{self.port}"
         print(f"正在打开浏览器: {url}")
         
         try:
-            if platform.system() == 'Windows':
+            if sys.platform == 'win32':
                 os.startfile(url)
-            elif platform.system() == 'Darwin':  # macOS
+            elif sys.platform == 'darwin':  # macOS
                 os.system(f'open "{url}"')
             else:  # Linux
                 os.system(f'xdg-open "{url}"')
@@ -667,27 +1236,47 @@ class FileTransferServer:
     async def run(self):
         """启动服务器"""
         try:
-            # 查找可用端口
-            self.port = find_available_port(self.port)
+            start = time.perf_counter()
+            
+            # 绑定可用端口，绑定好的socket直接交给服务器，避免二次绑定
+            sock = bind_available_port(self.host, self.port)
+            self.port = sock.getsockname()[1]
+            
+            local_ip = self.get_local_ip()
+            
+            # HTTPS模式：加载（或首次生成）自签名证书
+            if self.use_https:
+                cert_file, key_file = ensure_self_signed_cert(self.cert_dir, [local_ip])
+                self.ssl_context = create_ssl_context(cert_file, key_file)
             
             runner = web.AppRunner(self.app)
             await runner.setup()
-            site = web.TCPSite(runner, self.host, self.port)
+            site = web.SockSite(runner, sock, ssl_context=self.ssl_context)
             await site.start()
+            self.startup_timings.append(('启动监听', time.perf_counter() - start))
             
-            local_ip = self.get_local_ip()
+            # 开始监听后再在后台加载聊天历史
+            self.history_task = asyncio.create_task(self.load_chat_history())
             
             print("\n" + "="*60)
             print("🚀 文件传输服务器已启动！")
             print("="*60)
-            print(f"💻 本机访问: http://localhost:{self.port}")
-            print(f"📱 手机访问: http://{local_ip}:{self.port}")
+            print(f"💻 本机访问: {self.scheme}://localhost:{self.port}")
+            print(f"📱 手机访问: {self.public_url or f'{self.scheme}://{local_ip}:{self.port}'}")
+            if self.public_url:
+                print(f"🔀 后端地址: {self.scheme}://{local_ip}:{self.port}（反向代理应指向此地址）")
+            if self.use_https:
+                print("🔐 使用自签名证书，首次访问需在浏览器中确认信任")
             print("="*60)
             print(f"📂 上传目录: {self.upload_dir.absolute()}")
             print(f"💬 聊天文件: {self.chat_file.absolute()}")
             print("💡 拖拽文件到网页即可上传，支持文字共享")
             print("="*60)
             
+            if self.profile_startup:
+                await self.wait_chat_history()
+                self.print_startup_profile()
+            
             self.open_browser()
             
             try:
@@ -703,22 +1292,19 @@ class FileTransferServer:
             traceback.print_exc()
 
 if __name__ == '__main__':
-    # 确保目录存在
-    if getattr(sys, 'frozen', False):
-        base_dir = os.path.dirname(sys.executable)
-    else:
-        base_dir = os.getcwd()
-    
-    uploads_dir = Path(base_dir) / 'uploads'
-    chat_dir = Path(base_dir) / 'chat'
-    
-    uploads_dir.mkdir(exist_ok=True)
-    chat_dir.mkdir(exist_ok=True)
+    parser = argparse.ArgumentParser(description='局域网文件传输服务器')
+    parser.add_argument('--port', type=int, default=8888, help='起始端口（默认8888）')
+    parser.add_argument('--https', action='store_true', help='启用HTTPS，首次运行自动生成自签名证书')
+    parser.add_argument('--public-url', help='对外公布的地址（如前置HTTP/2反向代理的https地址），用于二维码和打开浏览器')
+    parser.add_argument('--profile-startup', action='store_true', help='输出模块导入和初始化耗时')
+    args = parser.parse_args()
     
     print("正在启动文件传输服务器...")
     
     try:
-        server = FileTransferServer()
+        server = FileTransferServer(port=args.port, use_https=args.https,
+                                    profile_startup=args.profile_startup,
+                                    public_url=args.public_url)
         asyncio.run(server.run())
     except KeyboardInterrupt:
         print("\n👋 服务器已停止")